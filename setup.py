@@ -1,11 +1,70 @@
 # -*- coding: utf8 -*-
-from setuptools import setup
-from os import path
+import sys
+from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext as _build_ext
+from os import path, environ
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
 
 this_directory = path.abspath(path.dirname(__file__))
 with open(path.join(this_directory, 'README.md'), encoding='utf-8') as f:
     long_description = f.read()
 
+# Let the compiler vectorise and tune the kernels for this machine.
+# Set TMSCORING_NATIVE=0 to build for other machines (e.g. for wheels);
+# the AVX2 path of _simd.c is still selected at runtime.
+native = environ.get('TMSCORING_NATIVE', '1') != '0'
+if sys.platform == 'win32':
+    compile_args = ['/O2', '/fp:fast']
+    if native:
+        compile_args.append('/arch:AVX2')
+    link_args = []
+else:
+    compile_args = ['-O3', '-ffast-math', '-funroll-loops', '-ftree-vectorize']
+    if native:
+        compile_args.append('-march=native')
+    link_args = ['-lm']
+
+
+
+class SharedLibrary(Extension):
+    """
+    A plain shared library, loaded with ctypes instead of imported.
+    """
+
+
+class build_ext(_build_ext):
+    # No module init function is exported, and the file is named as a
+    # shared library of the platform, not as an extension module.
+    def get_export_symbols(self, ext):
+        if isinstance(ext, SharedLibrary):
+            return ext.export_symbols
+        return super().get_export_symbols(ext)
+
+    def get_ext_filename(self, fullname):
+        if isinstance(self.ext_map.get(fullname), SharedLibrary):
+            suffix = {'win32': '.dll', 'darwin': '.dylib'}.get(sys.platform, '.so')
+            return path.join(*fullname.split('.')) + suffix
+        return super().get_ext_filename(fullname)
+
+
+# Optional: if they fail to build, the pure Python kernels are used.
+ext_modules = [SharedLibrary('tmscoring.libtmsimd', ['tmscoring/_simd.c'],
+                             extra_compile_args=compile_args,
+                             extra_link_args=link_args,
+                             optional=True)]
+if cythonize is not None:
+    ext_modules += cythonize([Extension('tmscoring._tm_kernel', ['tmscoring/_tm_kernel.pyx'],
+                                        extra_compile_args=compile_args,
+                                        extra_link_args=link_args,
+                                        optional=True)],
+                             language_level=3,
+                             compiler_directives={'boundscheck': False,
+                                                  'cdivision': True})
+
 setup(name='tmscoring', version='0.4.post0',
       description='Python implementation of the TMscore program',
       url='https://github.com/Dapid/tmscoring',
@@ -13,13 +72,15 @@ setup(name='tmscoring', version='0.4.post0',
       author_email='davidmenhur@gmail.com',
       license='BSD 3-clause',
       packages=['tmscoring'],
+      ext_modules=ext_modules,
+      cmdclass={'build_ext': build_ext},
+      python_requires='>=3.7',
       install_requires=['numpy', 'iminuit<2', 'biopython'],
       test_suite='nose.collector',
       tests_require=['nose'],
       long_description=long_description,
       long_description_content_type='text/markdown',
       classifiers=['Programming Language :: Python',
-                   'Programming Language :: Python :: 2',
                    'Programming Language :: Python :: 3',
                    'Topic :: Scientific/Engineering :: Bio-Informatics',
                    'Intended Audience :: Science/Research',
@@ -1,4 +1,3 @@
-from __future__ import absolute_import
-
-from .tmscore import Aligning, TMscoring, Sscoring, RMSDscoring, get_tm, get_rmsd
+from .tmscore import (Aligning, TMscoring, Sscoring, RMSDscoring, get_tm, get_rmsd,
+                      get_tm_many, get_rmsd_many)
 __version__ = 0.3
@@ -0,0 +1,202 @@
+"""
+Scoring kernels for the minimisation hot loop.
+
+In order of preference: the compiled SIMD library, the Cython extension,
+Numba, and plain NumPy.
+All of them take (3, N) coordinates with contiguous rows, with R and t of the
+same floating point type (float64 or float32). Rows may be padded, as in the
+arrays made by aligned_coords.
+"""
+import ctypes
+import os
+import sys
+
+import numpy as np
+
+try:
+    from ._tm_kernel import tm_core
+except ImportError:
+    tm_core = None
+
+# Replaced by numba.prange in _load_numba.
+prange = range
+
+
+# Residues per block in the NumPy kernel, so that the temporaries of very
+# long chains stay in L2. Smaller blocks lose more to NumPy call overhead
+# than they gain from the cache.
+TILE = 8192
+
+
+# Byte alignment of the coordinate rows, the width of an AVX register.
+ALIGN = 32
+
+
+def aligned_empty(shape, dtype, align=ALIGN):
+    """
+    Like np.empty, but the data starts at a multiple of align bytes.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -buf.ctypes.data % align
+    return buf[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+def aligned_coords(coords, align=ALIGN):
+    """
+    Copy (3, N) coordinates so that every row starts at a multiple of align
+    bytes, padding the rows with zeros. Returns a (3, N) view of the copy.
+    """
+    lanes = align // coords.itemsize
+    n = coords.shape[1]
+    padded = aligned_empty((coords.shape[0], -(-n // lanes) * lanes), coords.dtype, align)
+    padded[:, n:] = 0
+    padded[:, :n] = coords
+    return padded[:, :n]
+
+
+def _tm_kernel_numpy(R, t, c2, c1, d02):
+    s = 0.0
+    for j in range(0, c2.shape[1], TILE):
+        dist = R.dot(c2[:, j:j + TILE])
+        dist += t[:, None]
+        dist -= c1[:, j:j + TILE]
+        d_i2 = np.einsum('ij,ij->j', dist, dist)
+        d_i2 += d02
+        s += np.reciprocal(d_i2, out=d_i2).sum()
+    return -d02 * s
+
+
+def _tm_point(R, t, c2, c1, d02, j):
+    x = R[0, 0] * c2[0, j] + R[0, 1] * c2[1, j] + R[0, 2] * c2[2, j] + t[0] - c1[0, j]
+    y = R[1, 0] * c2[0, j] + R[1, 1] * c2[1, j] + R[1, 2] * c2[2, j] + t[1] - c1[1, j]
+    z = R[2, 0] * c2[0, j] + R[2, 1] * c2[1, j] + R[2, 2] * c2[2, j] + t[2] - c1[2, j]
+    d2 = x * x + y * y + z * z
+    return 1.0 / (d02 + d2)
+
+
+def _tm_range(R, t, c2, c1, d02, start, stop):
+    # Rotation, translation, distance and score in a single pass,
+    # without temporaries. Unrolled with four independent accumulators,
+    # so consecutive additions do not wait on each other.
+    stop4 = stop - (stop - start) % 4
+    s0 = s1 = s2 = s3 = 0.0
+    for j in range(start, stop4, 4):
+        s0 += _tm_point(R, t, c2, c1, d02, j)
+        s1 += _tm_point(R, t, c2, c1, d02, j + 1)
+        s2 += _tm_point(R, t, c2, c1, d02, j + 2)
+        s3 += _tm_point(R, t, c2, c1, d02, j + 3)
+    for j in range(stop4, stop):
+        s0 += _tm_point(R, t, c2, c1, d02, j)
+    return (s0 + s1) + (s2 + s3)
+
+
+def _tm_kernel_loop(R, t, c2, c1, d02):
+    return -d02 * _tm_range(R, t, c2, c1, d02, 0, c2.shape[1])
+
+
+def _tm_kernel_prange(R, t, c2, c1, d02):
+    # Blocks of TILE_PARALLEL residues, distributed over threads.
+    n = c2.shape[1]
+    s = 0.0
+    for k in prange((n + TILE_PARALLEL - 1) // TILE_PARALLEL):
+        start = k * TILE_PARALLEL
+        s += _tm_range(R, t, c2, c1, d02, start, min(start + TILE_PARALLEL, n))
+    return -d02 * s
+
+
+# Residues per thread in the parallel kernel. Shorter chains are not worth
+# the cost of starting the threads.
+TILE_PARALLEL = 2048
+
+_tm_kernel_serial = _tm_kernel_parallel = None
+
+
+def _load_numba():
+    """
+    Compile the kernels above with Numba, if it is installed.
+    Returns whether it is.
+
+    Numba is only imported here, when it is going to be used: importing it
+    takes longer than the rest of tmscoring.
+    """
+    global prange, _tm_point, _tm_range, _tm_kernel_serial, _tm_kernel_parallel
+    if _tm_kernel_serial is not None:
+        return True
+    try:
+        import numba
+    except ImportError:
+        return False
+
+    prange = numba.prange
+    _tm_point = numba.njit(inline='always', fastmath=True, cache=True)(_tm_point)
+    _tm_range = numba.njit(inline='always', fastmath=True, cache=True)(_tm_range)
+    _tm_kernel_serial = numba.njit(fastmath=True, cache=True)(_tm_kernel_loop)
+    _tm_kernel_parallel = numba.njit(fastmath=True, cache=True, parallel=True)(_tm_kernel_prange)
+    return True
+
+
+def _tm_kernel_numba(R, t, c2, c1, d02):
+    if c2.shape[1] > TILE_PARALLEL:
+        return _tm_kernel_parallel(R, t, c2, c1, d02)
+    return _tm_kernel_serial(R, t, c2, c1, d02)
+
+
+def parallel_kernel_used():
+    """
+    Whether the parallel Numba kernel may have run in this process. Its
+    thread pool can deadlock processes forked afterwards.
+    """
+    return _tm_kernel_parallel is not None and bool(_tm_kernel_parallel.signatures)
+
+
+# The shared library built from _simd.c, see setup.py.
+SIMD_LIBRARY = 'libtmsimd' + {'win32': '.dll', 'darwin': '.dylib'}.get(sys.platform, '.so')
+
+
+def _load_simd():
+    """
+    Load the optional library built from _simd.c, if present.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), SIMD_LIBRARY)
+    if not os.path.exists(path):
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError:
+        return None
+    lib.tm_score.restype = ctypes.c_double
+    lib.tm_score.argtypes = (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int,
+                             ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_double)
+    lib.tm_score_f.restype = ctypes.c_double
+    lib.tm_score_f.argtypes = (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int,
+                               ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_float)
+    return lib
+
+
+_simd = _load_simd()
+
+
+def _tm_kernel_simd(R, t, c2, c1, d02):
+    # The C code takes a single row stride for both arrays.
+    if c2.strides != c1.strides or c2.strides[1] != c2.itemsize:
+        c2 = np.ascontiguousarray(c2)
+        c1 = np.ascontiguousarray(c1)
+    tm_score = _simd.tm_score_f if c2.dtype == np.float32 else _simd.tm_score
+    return -tm_score(c2.ctypes.data, c1.ctypes.data, c2.shape[1],
+                     c2.strides[0] // c2.itemsize, R.ctypes.data, t.ctypes.data, d02)
+
+
+def _tm_kernel_cython(R, t, c2, c1, d02):
+    return tm_core(c2, c1, R, t, d02)
+
+
+if _simd is not None:
+    tm_kernel = _tm_kernel_simd
+elif tm_core is not None:
+    tm_kernel = _tm_kernel_cython
+elif _load_numba():
+    tm_kernel = _tm_kernel_numba
+else:
+    tm_kernel = _tm_kernel_numpy
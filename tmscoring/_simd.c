@@ -0,0 +1,259 @@
+/*
+ * TM score kernel, vectorised across residues.
+ *
+ * Coordinates are passed as (3, N) arrays whose x, y and z rows are
+ * contiguous blocks of N values, ld values apart. When the rows start at
+ * 32 byte boundaries (see aligned_coords in _kernels.py) the AVX2 code uses
+ * aligned loads. There are double (tm_score)
+ * and single (tm_score_f) precision versions. The library is loaded
+ * through ctypes from tmscoring/_kernels.py.
+ */
+#include <stddef.h>
+#include <stdint.h>
+
+#if defined(_WIN32)
+#define TM_EXPORT __declspec(dllexport)
+#else
+#define TM_EXPORT
+#endif
+
+#if (defined(__GNUC__) || defined(__clang__)) && (defined(__x86_64__) || defined(__i386__))
+#define TM_HAVE_AVX2 1
+#include <immintrin.h>
+#endif
+
+
+static double tm_score_scalar(const double *c2, const double *c1, ptrdiff_t start,
+                              ptrdiff_t n, ptrdiff_t ld, const double *R, const double *t,
+                              double d02)
+{
+    const double *x2 = c2, *y2 = c2 + ld, *z2 = c2 + 2 * ld;
+    const double *x1 = c1, *y1 = c1 + ld, *z1 = c1 + 2 * ld;
+    double s = 0.0;
+    ptrdiff_t j;
+
+    for (j = start; j < n; j++) {
+        double x = R[0] * x2[j] + R[1] * y2[j] + R[2] * z2[j] + t[0] - x1[j];
+        double y = R[3] * x2[j] + R[4] * y2[j] + R[5] * z2[j] + t[1] - y1[j];
+        double z = R[6] * x2[j] + R[7] * y2[j] + R[8] * z2[j] + t[2] - z1[j];
+        double d2 = x * x + y * y + z * z;
+        s += 1.0 / (d02 + d2);
+    }
+    return d02 * s;
+}
+
+
+#ifdef TM_HAVE_AVX2
+#define TM_AVX2 __attribute__((target("avx2,fma")))
+
+/* Whether all six rows start at 32 byte boundaries. */
+static inline int tm_rows_aligned(const void *c2, const void *c1, size_t row_bytes)
+{
+    return ((uintptr_t)c2 | (uintptr_t)c1 | row_bytes) % 32 == 0;
+}
+
+/* Rotation, translation, 1 and 1 / d02 broadcast to all lanes. */
+typedef struct {
+    __m256d R[9], t[3], one, inv_d02;
+} tm_consts_pd;
+
+
+/* aligned is a compile time constant at every call site. */
+TM_AVX2 static inline __m256d tm_load_pd(const double *p, int aligned)
+{
+    return aligned ? _mm256_load_pd(p) : _mm256_loadu_pd(p);
+}
+
+
+/* Scores of the 4 residues starting at j. */
+TM_AVX2 static inline __m256d tm_block_pd(const tm_consts_pd *k, const double *c2,
+                                          const double *c1, ptrdiff_t ld, ptrdiff_t j,
+                                          int aligned)
+{
+    __m256d x2v = tm_load_pd(c2 + j, aligned);
+    __m256d y2v = tm_load_pd(c2 + ld + j, aligned);
+    __m256d z2v = tm_load_pd(c2 + 2 * ld + j, aligned);
+    __m256d xd = _mm256_fmadd_pd(k->R[0], x2v, _mm256_fmadd_pd(k->R[1], y2v, _mm256_fmadd_pd(k->R[2], z2v, _mm256_sub_pd(k->t[0], tm_load_pd(c1 + j, aligned)))));
+    __m256d yd = _mm256_fmadd_pd(k->R[3], x2v, _mm256_fmadd_pd(k->R[4], y2v, _mm256_fmadd_pd(k->R[5], z2v, _mm256_sub_pd(k->t[1], tm_load_pd(c1 + ld + j, aligned)))));
+    __m256d zd = _mm256_fmadd_pd(k->R[6], x2v, _mm256_fmadd_pd(k->R[7], y2v, _mm256_fmadd_pd(k->R[8], z2v, _mm256_sub_pd(k->t[2], tm_load_pd(c1 + 2 * ld + j, aligned)))));
+    __m256d d2 = _mm256_fmadd_pd(xd, xd, _mm256_fmadd_pd(yd, yd, _mm256_mul_pd(zd, zd)));
+    return _mm256_div_pd(k->one, _mm256_fmadd_pd(d2, k->inv_d02, k->one));
+}
+
+
+/* Sum over the first n - n % 4 residues. */
+TM_AVX2 static inline double tm_sum_pd(const tm_consts_pd *k, const double *c2,
+                                       const double *c1, ptrdiff_t n, ptrdiff_t ld,
+                                       int aligned)
+{
+    __m256d acc0 = _mm256_setzero_pd(), acc1 = _mm256_setzero_pd();
+    __m256d acc2 = _mm256_setzero_pd(), acc3 = _mm256_setzero_pd();
+    double lanes[4];
+    ptrdiff_t j;
+
+    /* Four independent accumulators, to hide the latency of the additions. */
+    for (j = 0; j + 16 <= n; j += 16) {
+        acc0 = _mm256_add_pd(acc0, tm_block_pd(k, c2, c1, ld, j, aligned));
+        acc1 = _mm256_add_pd(acc1, tm_block_pd(k, c2, c1, ld, j + 4, aligned));
+        acc2 = _mm256_add_pd(acc2, tm_block_pd(k, c2, c1, ld, j + 8, aligned));
+        acc3 = _mm256_add_pd(acc3, tm_block_pd(k, c2, c1, ld, j + 12, aligned));
+    }
+    for (; j + 4 <= n; j += 4)
+        acc0 = _mm256_add_pd(acc0, tm_block_pd(k, c2, c1, ld, j, aligned));
+
+    acc0 = _mm256_add_pd(_mm256_add_pd(acc0, acc1), _mm256_add_pd(acc2, acc3));
+    _mm256_storeu_pd(lanes, acc0);
+    return (lanes[0] + lanes[1]) + (lanes[2] + lanes[3]);
+}
+
+
+TM_AVX2 static double tm_score_avx2(const double *c2, const double *c1, ptrdiff_t n,
+                                    ptrdiff_t ld, const double *R, const double *t,
+                                    double d02)
+{
+    tm_consts_pd k;
+    double s;
+    int i;
+
+    for (i = 0; i < 9; i++)
+        k.R[i] = _mm256_set1_pd(R[i]);
+    for (i = 0; i < 3; i++)
+        k.t[i] = _mm256_set1_pd(t[i]);
+    k.one = _mm256_set1_pd(1.0);
+    k.inv_d02 = _mm256_set1_pd(1.0 / d02);
+
+    if (tm_rows_aligned(c2, c1, ld * sizeof(double)))
+        s = tm_sum_pd(&k, c2, c1, n, ld, 1);
+    else
+        s = tm_sum_pd(&k, c2, c1, n, ld, 0);
+    return s + tm_score_scalar(c2, c1, n - n % 4, n, ld, R, t, d02);
+}
+#endif
+
+
+static double tm_score_f_scalar(const float *c2, const float *c1, ptrdiff_t start,
+                                ptrdiff_t n, ptrdiff_t ld, const float *R, const float *t,
+                                float d02)
+{
+    const float *x2 = c2, *y2 = c2 + ld, *z2 = c2 + 2 * ld;
+    const float *x1 = c1, *y1 = c1 + ld, *z1 = c1 + 2 * ld;
+    double s = 0.0;
+    ptrdiff_t j;
+
+    for (j = start; j < n; j++) {
+        float x = R[0] * x2[j] + R[1] * y2[j] + R[2] * z2[j] + t[0] - x1[j];
+        float y = R[3] * x2[j] + R[4] * y2[j] + R[5] * z2[j] + t[1] - y1[j];
+        float z = R[6] * x2[j] + R[7] * y2[j] + R[8] * z2[j] + t[2] - z1[j];
+        float d2 = x * x + y * y + z * z;
+        s += 1.0 / (d02 + d2);
+    }
+    return d02 * s;
+}
+
+
+#ifdef TM_HAVE_AVX2
+typedef struct {
+    __m256 R[9], t[3], one, inv_d02;
+} tm_consts_ps;
+
+
+TM_AVX2 static inline __m256 tm_load_ps(const float *p, int aligned)
+{
+    return aligned ? _mm256_load_ps(p) : _mm256_loadu_ps(p);
+}
+
+
+/* Scores of the 8 residues starting at j. */
+TM_AVX2 static inline __m256 tm_block_ps(const tm_consts_ps *k, const float *c2,
+                                         const float *c1, ptrdiff_t ld, ptrdiff_t j,
+                                         int aligned)
+{
+    __m256 x2v = tm_load_ps(c2 + j, aligned);
+    __m256 y2v = tm_load_ps(c2 + ld + j, aligned);
+    __m256 z2v = tm_load_ps(c2 + 2 * ld + j, aligned);
+    __m256 xd = _mm256_fmadd_ps(k->R[0], x2v, _mm256_fmadd_ps(k->R[1], y2v, _mm256_fmadd_ps(k->R[2], z2v, _mm256_sub_ps(k->t[0], tm_load_ps(c1 + j, aligned)))));
+    __m256 yd = _mm256_fmadd_ps(k->R[3], x2v, _mm256_fmadd_ps(k->R[4], y2v, _mm256_fmadd_ps(k->R[5], z2v, _mm256_sub_ps(k->t[1], tm_load_ps(c1 + ld + j, aligned)))));
+    __m256 zd = _mm256_fmadd_ps(k->R[6], x2v, _mm256_fmadd_ps(k->R[7], y2v, _mm256_fmadd_ps(k->R[8], z2v, _mm256_sub_ps(k->t[2], tm_load_ps(c1 + 2 * ld + j, aligned)))));
+    __m256 d2 = _mm256_fmadd_ps(xd, xd, _mm256_fmadd_ps(yd, yd, _mm256_mul_ps(zd, zd)));
+    return _mm256_div_ps(k->one, _mm256_fmadd_ps(d2, k->inv_d02, k->one));
+}
+
+
+/* Sum over the first n - n % 8 residues. */
+TM_AVX2 static inline double tm_sum_ps(const tm_consts_ps *k, const float *c2,
+                                       const float *c1, ptrdiff_t n, ptrdiff_t ld,
+                                       int aligned)
+{
+    __m256 acc0 = _mm256_setzero_ps(), acc1 = _mm256_setzero_ps();
+    __m256 acc2 = _mm256_setzero_ps(), acc3 = _mm256_setzero_ps();
+    float lanes[8];
+    double s = 0.0;
+    ptrdiff_t j;
+    int i;
+
+    for (j = 0; j + 32 <= n; j += 32) {
+        acc0 = _mm256_add_ps(acc0, tm_block_ps(k, c2, c1, ld, j, aligned));
+        acc1 = _mm256_add_ps(acc1, tm_block_ps(k, c2, c1, ld, j + 8, aligned));
+        acc2 = _mm256_add_ps(acc2, tm_block_ps(k, c2, c1, ld, j + 16, aligned));
+        acc3 = _mm256_add_ps(acc3, tm_block_ps(k, c2, c1, ld, j + 24, aligned));
+    }
+    for (; j + 8 <= n; j += 8)
+        acc0 = _mm256_add_ps(acc0, tm_block_ps(k, c2, c1, ld, j, aligned));
+
+    acc0 = _mm256_add_ps(_mm256_add_ps(acc0, acc1), _mm256_add_ps(acc2, acc3));
+    _mm256_storeu_ps(lanes, acc0);
+    for (i = 0; i < 8; i++)
+        s += lanes[i];
+    return s;
+}
+
+
+TM_AVX2 static double tm_score_f_avx2(const float *c2, const float *c1, ptrdiff_t n,
+                                      ptrdiff_t ld, const float *R, const float *t,
+                                      float d02)
+{
+    tm_consts_ps k;
+    double s;
+    int i;
+
+    for (i = 0; i < 9; i++)
+        k.R[i] = _mm256_set1_ps(R[i]);
+    for (i = 0; i < 3; i++)
+        k.t[i] = _mm256_set1_ps(t[i]);
+    k.one = _mm256_set1_ps(1.0f);
+    k.inv_d02 = _mm256_set1_ps(1.0f / d02);
+
+    if (tm_rows_aligned(c2, c1, ld * sizeof(float)))
+        s = tm_sum_ps(&k, c2, c1, n, ld, 1);
+    else
+        s = tm_sum_ps(&k, c2, c1, n, ld, 0);
+    return s + tm_score_f_scalar(c2, c1, n - n % 8, n, ld, R, t, d02);
+}
+#endif
+
+
+/*
+ * Return sum_j 1 / (1 + |R c2_j + t - c1_j|^2 / d02), where row i of c1 and
+ * c2 starts at element i * ld.
+ */
+TM_EXPORT double tm_score(const double *c2, const double *c1, int n, int ld,
+                          const double *R, const double *t, double d02)
+{
+#ifdef TM_HAVE_AVX2
+    if (__builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma"))
+        return tm_score_avx2(c2, c1, n, ld, R, t, d02);
+#endif
+    return tm_score_scalar(c2, c1, 0, n, ld, R, t, d02);
+}
+
+
+TM_EXPORT double tm_score_f(const float *c2, const float *c1, int n, int ld,
+                            const float *R, const float *t, float d02)
+{
+#ifdef TM_HAVE_AVX2
+    if (__builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma"))
+        return tm_score_f_avx2(c2, c1, n, ld, R, t, d02);
+#endif
+    return tm_score_f_scalar(c2, c1, 0, n, ld, R, t, d02);
+}
+
@@ -0,0 +1,23 @@
+# cython: language_level=3
+"""
+Cython version of the TM score kernel, for when the SIMD extension is not
+available. Same arguments and result as tm_kernel in _kernels.py.
+"""
+cimport cython
+from cython cimport floating
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef double tm_core(floating[:, :] c2, floating[:, :] c1,
+                     floating[:, ::1] R, floating[::1] t, double d02) noexcept nogil:
+    cdef Py_ssize_t j
+    cdef double x, y, z, s = 0.0
+
+    for j in range(c2.shape[1]):
+        x = R[0, 0] * c2[0, j] + R[0, 1] * c2[1, j] + R[0, 2] * c2[2, j] + t[0] - c1[0, j]
+        y = R[1, 0] * c2[0, j] + R[1, 1] * c2[1, j] + R[1, 2] * c2[2, j] + t[1] - c1[1, j]
+        z = R[2, 0] * c2[0, j] + R[2, 1] * c2[1, j] + R[2, 2] * c2[2, j] + t[2] - c1[2, j]
+        s += 1.0 / (d02 + x * x + y * y + z * z)
+    return -d02 * s
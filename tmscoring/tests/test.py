@@ -1,11 +1,12 @@
-from __future__ import division
-
+import os
 import subprocess
+import tempfile
 import tmscoring
 import numpy as np
-from numpy.testing import assert_almost_equal, TestCase
+from numpy.testing import assert_allclose, assert_almost_equal, TestCase
 from nose.exc import SkipTest
 from shutil import which
+from tmscoring import _kernels
 
 
 class TestAligningBase(TestCase):
@@ -32,18 +33,151 @@ class TestAligningBase(TestCase):
 
             assert np.all(0 <= -tm / align_object.N)
 
+    def test_tm_kernel(self):
+        align_object = tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb')
+        np.random.seed(124)
+        for _ in range(100):
+            theta, phi, psi = 2 * np.pi * np.random.random(3)
+            dx, dy, dz = 10 * np.random.random(3)
+
+            tm = align_object._tm(theta, phi, psi, dx, dy, dz).sum()
+            tm_sum = align_object._tm_sum(theta, phi, psi, dx, dy, dz)
+
+            assert_almost_equal(tm, tm_sum, 6)
+
+    def test_precision(self):
+        align_64 = tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb', precision='fp64')
+        align_32 = tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb', precision='fp32')
+        assert align_32.coord1.dtype == np.float32
+        np.random.seed(124)
+        for _ in range(100):
+            theta, phi, psi = 2 * np.pi * np.random.random(3)
+            dx, dy, dz = 10 * np.random.random(3)
+
+            tm_64 = align_64.tmscore(theta, phi, psi, dx, dy, dz)
+            tm_32 = align_32.tmscore(theta, phi, psi, dx, dy, dz)
+            assert tm_32.dtype == np.float64
+            assert_almost_equal(tm_64, tm_32, 5)
+
+            tm_64 = align_64._tm_sum(theta, phi, psi, dx, dy, dz)
+            tm_32 = align_32._tm_sum(theta, phi, psi, dx, dy, dz)
+            assert_almost_equal(tm_64, tm_32, 4)
+
+    def test_aligned_coords(self):
+        for precision in ('fp64', 'fp32'):
+            align_object = tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb', precision=precision)
+            for coord in (align_object.coord1, align_object.coord2):
+                assert coord.ctypes.data % 32 == 0
+                assert coord.strides[0] % 32 == 0
+                assert coord.strides[1] == coord.itemsize
+
     def test_load_data_alignment(self):
         align_object = tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb', mode='align')
-        assert align_object.coord1.shape[0] == 4
-        assert align_object.coord2.shape[0] == 4
+        assert align_object.coord1.shape[0] == 3
+        assert align_object.coord2.shape[0] == 3
         assert align_object.coord1.shape == align_object.coord2.shape
 
     def test_load_data_index(self):
         align_object = tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb', mode='index')
-        assert align_object.coord1.shape[0] == 4
-        assert align_object.coord2.shape[0] == 4
+        assert align_object.coord1.shape[0] == 3
+        assert align_object.coord2.shape[0] == 3
         assert align_object.coord1.shape == align_object.coord2.shape
 
+    def test_load_data_cached(self):
+        align_object = tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb')
+        hits = tmscoring.tmscore._parse_coords.cache_info().hits
+        align_cached = tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb')
+        assert tmscoring.tmscore._parse_coords.cache_info().hits == hits + 2
+        assert np.array_equal(align_object.coord1, align_cached.coord1)
+        assert np.array_equal(align_object.coord2, align_cached.coord2)
+
+        # The same entries serve both modes and any chain.
+        tmscoring.Aligning('pdb1.pdb', 'pdb2.pdb', mode='align', chain_1='B')
+        assert tmscoring.tmscore._parse_coords.cache_info().hits == hits + 4
+
+def _kernel_args(n, dtype):
+    """
+    Random rotation, translation and (3, n) coordinates for the kernels.
+    """
+    np.random.seed(124)
+    R = np.linalg.qr(np.random.normal(size=(3, 3)))[0].astype(dtype)
+    t = np.random.normal(size=3).astype(dtype)
+    c2 = (10 * np.random.normal(size=(3, n))).astype(dtype)
+    c1 = (10 * np.random.normal(size=(3, n))).astype(dtype)
+    return R, t, c2, c1
+
+
+def _check_kernel(kernel, R, t, c2, c1, d02=16.):
+    R64, t64, c2_64, c1_64 = (a.astype(np.float64) for a in (R, t, c2, c1))
+    dist = R64 @ c2_64 + t64[:, None] - c1_64
+    reference = -d02 * np.sum(1 / (d02 + np.sum(dist ** 2, axis=0)))
+    rtol = 1e-5 if c2.dtype == np.float32 else 1e-12
+    assert_allclose(kernel(R, t, c2, c1, d02), reference, rtol=rtol)
+
+
+def test_tm_kernel_numpy():
+    tile = _kernels.TILE
+    for dtype in (np.float64, np.float32):
+        for n in (0, tile, tile + 1, 2 * tile + 3):
+            _check_kernel(_kernels._tm_kernel_numpy, *_kernel_args(n, dtype))
+
+
+def test_tm_kernel_numba():
+    if not _kernels._load_numba():
+        raise SkipTest('Numba is not installed in the system.')
+
+    tile = _kernels.TILE_PARALLEL
+    for dtype in (np.float64, np.float32):
+        # Serial below TILE_PARALLEL, parallel above.
+        for n in (7, tile - 1, tile, tile + 1, 5 * tile + 3):
+            R, t, c2, c1 = _kernel_args(n, dtype)
+            _check_kernel(_kernels._tm_kernel_numba, R, t, c2, c1)
+            _check_kernel(_kernels._tm_kernel_numba, R, t,
+                          _kernels.aligned_coords(c2), _kernels.aligned_coords(c1))
+
+
+def test_tm_kernel_cython():
+    if _kernels.tm_core is None:
+        raise SkipTest('The Cython kernel is not built.')
+
+    for dtype in (np.float64, np.float32):
+        for n in (0, 7, 145, 1001):
+            R, t, c2, c1 = _kernel_args(n, dtype)
+            _check_kernel(_kernels._tm_kernel_cython, R, t, c2, c1)
+            _check_kernel(_kernels._tm_kernel_cython, R, t,
+                          _kernels.aligned_coords(c2), _kernels.aligned_coords(c1))
+
+
+def _unaligned(coords):
+    """
+    Contiguous copy of coords that does not start at a 32 byte boundary.
+    """
+    n = coords.size
+    out = _kernels.aligned_empty(n + 1, coords.dtype)[1:].reshape(coords.shape)
+    out[...] = coords
+    return out
+
+
+def test_tm_kernel_simd():
+    if _kernels._simd is None:
+        raise SkipTest('The SIMD library is not built.')
+
+    kernel = _kernels._tm_kernel_simd
+    for dtype in (np.float64, np.float32):
+        # Leave a tail after the last full vector of 4 doubles or 8 floats.
+        for n in (5, 37, 1001, 1003):
+            R, t, c2, c1 = _kernel_args(n, dtype)
+            a2, a1 = _kernels.aligned_coords(c2), _kernels.aligned_coords(c1)
+            u2, u1 = _unaligned(c2), _unaligned(c1)
+            assert u2.ctypes.data % 32 != 0
+
+            _check_kernel(kernel, R, t, a2, a1)
+            _check_kernel(kernel, R, t, u2, u1)
+            # Different strides, laid out again as contiguous arrays.
+            _check_kernel(kernel, R, t, a2, c1)
+            _check_kernel(kernel, R, t, u2, a1)
+
+
 def test_identity():
     sc = tmscoring.TMscoring('pdb1.pdb', 'pdb1.pdb')
     assert sc.tmscore(0, 0, 0, 0, 0, 0) == 1
@@ -76,3 +210,71 @@ def test_repeated():
 
     assert_almost_equal(tm, 0.27426501120343644)
     assert_almost_equal(rmsd, 15.940038528551929)
+
+
+def test_write():
+    sc = tmscoring.TMscoring('pdb1.pdb', 'pdb2.pdb')
+    values = dict(theta=0.3, phi=-1.2, psi=2., dx=-15., dy=40., dz=3.)
+    sc._values = values
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outputfile = os.path.join(tmpdir, 'out.pdb')
+        sc.write(outputfile)
+        written = tmscoring.Aligning(outputfile, 'pdb2.pdb')
+
+    assert_almost_equal(written.coord1, sc._transform(**values), 3)
+
+
+def test_precision_offset():
+    # A structure far from the origin, against itself shifted by 0.5 A.
+    sc = tmscoring.TMscoring('pdb1.pdb', 'pdb1.pdb')
+    sc._values = dict(theta=0., phi=0., psi=0., dx=1000., dy=1000., dz=1000.)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shifted = os.path.join(tmpdir, 'shifted.pdb')
+        sc.write(shifted)
+        sc = tmscoring.TMscoring(shifted, shifted, precision='fp32')
+
+    values = dict(theta=0., phi=0., psi=0., dx=0.5, dy=0., dz=0.)
+    assert_almost_equal(sc.tmscore(**values), sc.d02 / (sc.d02 + 0.25), 7)
+    assert_almost_equal(sc.sscore(**values), sc.d0s2 / (sc.d0s2 + 0.25), 7)
+    assert_almost_equal(sc.rmsd(**values), 0.5, 7)
+
+
+def test_grad():
+    np.random.seed(124)
+    eps = 1e-6
+    for cls in (tmscoring.TMscoring, tmscoring.Sscoring, tmscoring.RMSDscoring):
+        sc = cls('pdb1.pdb', 'pdb2.pdb')
+        for _ in range(20):
+            params = np.concatenate((2 * np.pi * np.random.random(3),
+                                     10 * np.random.random(3)))
+            grad = sc.grad(*params)
+
+            for i in range(6):
+                step = np.zeros(6)
+                step[i] = eps
+                numerical = (sc(*(params + step)) - sc(*(params - step))) / (2 * eps)
+                assert_almost_equal(grad[i] / max(1, abs(numerical)),
+                                    numerical / max(1, abs(numerical)), 5)
+
+
+def test_many():
+    pairs = [('pdb1.pdb', 'pdb2.pdb'), ('pdbrep_1.pdb', 'pdbrep_2.pdb')]
+    tms = tmscoring.get_tm_many(pairs, workers=2)
+    assert_almost_equal(tms, [tmscoring.get_tm(*pair) for pair in pairs])
+
+
+def test_optimise_repeated():
+    sc = tmscoring.TMscoring('pdb1.pdb', 'pdb2.pdb')
+    values, tm, rmsd = sc.optimise()
+    first_values = dict(values)
+
+    _, tm_again, rmsd_again = sc.optimise()
+    assert_almost_equal(tm, tm_again, 6)
+    assert_almost_equal(rmsd, rmsd_again, 4)
+
+    _, tm_restart, _ = sc.optimise(restart=False)
+    assert tm_restart >= tm - 1e-6
+    # Values returned earlier are not modified by later optimisations.
+    assert values == first_values
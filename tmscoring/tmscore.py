@@ -1,6 +1,9 @@
-from __future__ import division
-
 import math
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 
@@ -9,15 +12,107 @@ import iminuit
 from Bio import PDB
 from Bio import pairwise2
 
+from ._kernels import aligned_coords, parallel_kernel_used, tm_kernel
+
 DTYPE = np.float64
 
+# Floating point types available for the optimisation.
+PRECISIONS = {'fp32': np.float32, 'fp64': np.float64}
+
+# ATOM records: columns 1-21, chain identifier, 23-30, x, y, z, and the rest.
+_ATOM_RE = re.compile(r'^(ATOM.{17})(.)(.{8})(.{8})(.{8})(.{8})(.*)$', re.M)
+
+
+def _apply_rt(R, t, c2, out=None):
+    """
+    Rotate and translate the (3, N) coordinates c2: R c2 + t.
+    """
+    out = np.dot(R, c2, out=out)
+    out += t[:, None]
+    return out
+
+
+def _fill_rotation(rotation, theta, phi, psi):
+    """
+    Write the rotation matrix for the given angles into the 3x3 array
+    rotation. Returns (cx, cy, cz, sx, sy, sz), the cosines and sines of
+    theta, phi and psi.
+    """
+    cx = math.cos(theta)
+    cy = math.cos(phi)
+    cz = math.cos(psi)
+    sx = math.sin(theta)
+    sy = math.sin(phi)
+    sz = math.sin(psi)
+    sxcy = sx * cy
+    cxcy = cx * cy
+
+    rotation[0, 0] = cx * cz - sxcy * sz
+    rotation[0, 1] = cx * sz + sxcy * cz
+    rotation[0, 2] = sx * sy
+    rotation[1, 0] = -sx * cz - cxcy * sz
+    rotation[1, 1] = -sx * sz + cxcy * cz
+    rotation[1, 2] = cx * sy
+    rotation[2, 0] = sy * sz
+    rotation[2, 1] = -sy * cz
+    rotation[2, 2] = cy
+    return cx, cy, cz, sx, sy, sz
+
+
+def _read_atoms(pdb_path, chain):
+    """
+    Find the ATOM records of the given chain, or without chain identifier,
+    in a single pass over the file. Returns the _ATOM_RE matches.
+    """
+    with open(pdb_path) as f:
+        return [m for m in _ATOM_RE.finditer(f.read())
+                if m.group(2) == chain or m.group(2) == ' ']
+
+
+def _load_coords(pdb_path):
+    """
+    Parse a PDB file, reusing the result if it has already been parsed
+    and has not been modified since.
+
+    Returns the residue numbers, whether each residue has a CA,
+    the (3, n_residues) CA coordinates (NaN if missing), and the sequence
+    of the first peptide (None if there is none).
+    """
+    path = os.path.abspath(pdb_path)
+    return _parse_coords(path, os.path.getmtime(path))
+
+
+@lru_cache(maxsize=256)
+def _parse_coords(path, mtime):
+    parser = PDB.PDBParser(QUIET=True)
+    structure = parser.get_structure(os.path.basename(path), path)
+
+    residues = list(structure.get_residues())
+    ids = tuple(r.id[1] for r in residues)
+    has_ca = tuple('CA' in r for r in residues)
+    coords = np.full((3, len(residues)), np.nan, dtype=DTYPE)
+    for j, r in enumerate(residues):
+        if has_ca[j]:
+            coords[:, j] = r['CA'].get_coord()
+    # Shared between all the instances loading this file.
+    coords.flags.writeable = False
+
+    # Only needed in 'align' mode, but cheap compared to parsing the file.
+    peptides = PDB.PPBuilder().build_peptides(structure)
+    seq = str(peptides[0].get_sequence()) if peptides else None
+    return ids, has_ca, coords, seq
+
 
 class Aligning(object):
-    def __init__(self, pdb_1, pdb_2, mode='index', chain_1='A', chain_2='A', d0s=5.):
+    def __init__(self, pdb_1, pdb_2, mode='index', chain_1='A', chain_2='A', d0s=5.,
+                 precision='fp64'):
         """
         pdb_1, pdb_2 are the file names for the PDB files.
         Chain
 
+        precision is the floating point type used to compute the scores,
+        'fp64' or 'fp32'. The latter is faster, and accurate enough for the
+        optimisation; the scores returned are always double precision.
         """
         self.pdb1 = pdb_1
         self.pdb2 = pdb_2
@@ -32,6 +127,30 @@ class Aligning(object):
         else:
             raise ValueError('Unrecognised mode {}'.format(mode))
 
+        try:
+            self.dtype = PRECISIONS[precision]
+        except KeyError:
+            raise ValueError('Unrecognised precision {}'.format(precision))
+        coord1, coord2 = self.coord1, self.coord2
+        # Rows aligned for the SIMD kernel.
+        self.coord1 = aligned_coords(coord1.astype(self.dtype, copy=False))
+        self.coord2 = aligned_coords(coord2.astype(self.dtype, copy=False))
+        # Double precision coordinates for the reported scores, see _d_i2_exact.
+        if self.dtype == DTYPE:
+            coord1, coord2 = self.coord1, self.coord2
+        self._coord1_exact = coord1
+        self._coord2_exact = coord2
+
+        # Scratch buffers, overwritten on every evaluation of the target.
+        self._rotation = np.zeros((3, 3), dtype=self.dtype)
+        self._rotation_exact = np.zeros((3, 3), dtype=DTYPE)
+        self._translation = np.zeros(3, dtype=self.dtype)
+        self._matrix = np.zeros((4, 4), dtype=DTYPE)
+        self._matrix[3, 3] = 1.
+        self._coord_buf = np.empty_like(self.coord1)
+        self._dist_buf = np.empty_like(self.coord1)
+        self._d2_buf = np.empty(self.coord1.shape[1], dtype=self.dtype)
+
         # Estimate d0 as TMscore does.
         d0 = 1.24 * (self.N - 15) ** (1.0 / 3.0) - 1.8
         self.d02 = d0 ** 2
@@ -42,20 +161,23 @@ class Aligning(object):
     def __call__(self, theta, phi, psi, dx, dy, dz):
         raise NotImplementedError('This method should be overriden by subclasses')
 
+    def grad(self, theta, phi, psi, dx, dy, dz):
+        raise NotImplementedError('This method should be overriden by subclasses')
+
     def get_default_values(self):
         """
         Make a crude estimation of the alignment using the center of mass
         and general C->N orientation.
         """
         out = dict(dx=0, dy=0, dz=0, theta=0, phi=0, psi=0)
-        dx, dy, dz, _ = np.mean(self.coord1 - self.coord2, axis=1)
+        dx, dy, dz = np.mean(self.coord1 - self.coord2, axis=1)
         out['dx'] = dx
         out['dy'] = dy
         out['dz'] = dz
 
         # C->N vector
-        vec1 = self.coord1[:-1, 1] - self.coord1[:-1, -1]
-        vec2 = self.coord2[:-1, 1] - self.coord2[:-1, -1]
+        vec1 = self.coord1[:, 1] - self.coord1[:, -1]
+        vec2 = self.coord2[:, 1] - self.coord2[:, -1]
         vec1 /= np.linalg.norm(vec1)
         vec2 /= np.linalg.norm(vec2)
 
@@ -80,10 +202,16 @@ class Aligning(object):
 
         return out
 
-    @staticmethod
-    def get_matrix(theta, phi, psi, dx, dy, dz,
-                   matrix=np.zeros((4, 4), dtype=DTYPE),
-                   angles=np.zeros(3, dtype=DTYPE)):
+    def get_rotation(self, theta, phi, psi):
+        """
+        Build the 3x3 rotation matrix.
+        """
+        # NB!: the returned array is overwritten on each call.
+        rotation = self._rotation
+        _fill_rotation(rotation, theta, phi, psi)
+        return rotation
+
+    def get_matrix(self, theta, phi, psi, dx, dy, dz):
         """
         Build the rotation-translation matrix.
 
@@ -94,27 +222,14 @@ class Aligning(object):
         [         | dz ]
         [ 0  0  0 | 1  ]
         """
-        # NB!: matrix and angles by default are being overwritten on each call
-        # thus, only created once at compile time.
-
-        angles[0] = theta
-        angles[1] = phi
-        angles[2] = psi
-
-        cx, cy, cz = np.cos(angles)
-        sx, sy, sz = np.sin(angles)
-
-        rotation = matrix[:3, :3]
-        rotation.flat = (cx * cz - sx * cy * sz,
-                         cx * sz + sx * cy * cz, sx * sy,
-                         -sx * cz - cx * cy * sz,
-                         -sx * sz + cx * cy * cz, cx * sy,
-                         sy * sz,
-                         -sy * cz, cy)
+        # NB!: the returned array is overwritten on each call.
+        matrix = self._matrix
+        matrix[:3, :3] = self.get_rotation(theta, phi, psi)
 
         # Translation component
-        matrix[:3, 3] = dx, dy, dz
-        matrix[3, 3] = 1.
+        matrix[0, 3] = dx
+        matrix[1, 3] = dy
+        matrix[2, 3] = dz
         return matrix
 
     def optimise(self, restart=True):
@@ -123,67 +238,186 @@ class Aligning(object):
         else:
             default = self.get_current_values()
 
-        m = iminuit.Minuit(self, error_theta=0.1, error_phi=0.1, error_psi=0.1,
+        m = iminuit.Minuit(self, grad=self.grad,
+                           error_theta=0.1, error_phi=0.1, error_psi=0.1,
                            error_dx=1, error_dy=1, error_dz=1, print_level=0, pedantic=False,
                            errordef=self.errordef(),
                            **default)
         m.migrad()
 
-        _values = m.values
+        # A copy, so that values returned earlier are not changed later.
+        _values = dict(m.values)
         self._values = _values
         return _values, self.tmscore(**_values), self.rmsd(**_values)
 
     def get_current_values(self):
         return self._values
 
-    def _tm(self, theta, phi, psi, dx, dy, dz):
+    def _transform(self, theta, phi, psi, dx, dy, dz):
         """
-        Compute the minimisation target, not normalised.
+        Apply the rotation-translation to the coordinates of the second structure.
         """
-        matrix = self.get_matrix(theta, phi, psi, dx, dy, dz)
-        coord = matrix.dot(self.coord2)
-        dist = coord - self.coord1
+        self.get_rotation(theta, phi, psi)
+        return self._apply(dx, dy, dz)
 
-        d_i2 = (dist * dist).sum(axis=0)
+    def _apply(self, dx, dy, dz):
+        """
+        Apply the rotation in self._rotation and the translation to the
+        coordinates of the second structure.
+        """
+        translation = self._translation
+        translation[0] = dx
+        translation[1] = dy
+        translation[2] = dz
+        return _apply_rt(self._rotation, translation, self.coord2, out=self._coord_buf)
 
-        tm = -(1 / (1 + (d_i2 / self.d02)))
+    def _dist(self, theta, phi, psi, dx, dy, dz):
+        """
+        Compute the distance vectors between the aligned residues.
 
-        return tm
+        The result is stored in a buffer that is overwritten on each call.
+        """
+        coord = self._transform(theta, phi, psi, dx, dy, dz)
+        return np.subtract(coord, self.coord1, out=self._dist_buf)
 
-    def _s(self, theta, phi, psi, dx, dy, dz):
+    def _dist_trig(self, theta, phi, psi, dx, dy, dz):
+        """
+        Like _dist, but also return the cosines and sines of the angles,
+        (cx, cy, cz, sx, sy, sz), for _grad.
+        """
+        trig = _fill_rotation(self._rotation, theta, phi, psi)
+        coord = self._apply(dx, dy, dz)
+        return np.subtract(coord, self.coord1, out=self._dist_buf), trig
+
+    def _d_i2_exact(self, theta, phi, psi, dx, dy, dz):
+        """
+        Compute the squared distance between the aligned residues from the
+        distance vectors, in double precision whatever the precision of the
+        optimisation. Used for the reported scores.
+        """
+        rotation = self._rotation_exact
+        _fill_rotation(rotation, theta, phi, psi)
+        translation = np.array((dx, dy, dz), dtype=DTYPE)
+
+        dist = _apply_rt(rotation, translation, self._coord2_exact)
+        dist -= self._coord1_exact
+        return np.einsum('ij,ij->j', dist, dist)
+
+    def _score_samples(self, d02, theta, phi, psi, dx, dy, dz):
+        """
+        Per residue d02 / (d02 + d^2), the TM or S scores.
+        """
+        d_i2 = self._d_i2_exact(theta, phi, psi, dx, dy, dz)
+        d_i2 += d02
+        return np.divide(d02, d_i2, out=d_i2)
+
+    def _tm(self, theta, phi, psi, dx, dy, dz):
         """
         Compute the minimisation target, not normalised.
         """
-        matrix = self.get_matrix(theta, phi, psi, dx, dy, dz)
-        coord = matrix.dot(self.coord2)
-        dist = coord - self.coord1
+        dist = self._dist(theta, phi, psi, dx, dy, dz)
+        d_i2 = np.einsum('ij,ij->j', dist, dist, out=self._d2_buf)
+        # 1 / (1 + d^2 / d0^2) = d0^2 / (d0^2 + d^2), one division less.
+        d_i2 += self.d02
+        np.reciprocal(d_i2, out=d_i2)
 
-        d_i2 = (dist * dist).sum(axis=0)
+        return -self.d02 * d_i2
 
-        tm = -(1 / (1 + (d_i2 / self.d0s2)))
+    def _tm_sum(self, theta, phi, psi, dx, dy, dz):
+        """
+        Compute the minimisation target, summed over all residues.
+        """
+        # This is what Minuit evaluates, so _fill_rotation is inlined here.
+        cx = math.cos(theta)
+        cy = math.cos(phi)
+        cz = math.cos(psi)
+        sx = math.sin(theta)
+        sy = math.sin(phi)
+        sz = math.sin(psi)
+        sxcy = sx * cy
+        cxcy = cx * cy
+
+        rotation = self._rotation
+        rotation[0, 0] = cx * cz - sxcy * sz
+        rotation[0, 1] = cx * sz + sxcy * cz
+        rotation[0, 2] = sx * sy
+        rotation[1, 0] = -sx * cz - cxcy * sz
+        rotation[1, 1] = -sx * sz + cxcy * cz
+        rotation[1, 2] = cx * sy
+        rotation[2, 0] = sy * sz
+        rotation[2, 1] = -sy * cz
+        rotation[2, 2] = cy
+
+        translation = self._translation
+        translation[0] = dx
+        translation[1] = dy
+        translation[2] = dz
+        return tm_kernel(rotation, translation, self.coord2, self.coord1,
+                         self.d02)
 
-        return tm
+    def _s(self, theta, phi, psi, dx, dy, dz):
+        """
+        Compute the minimisation target, not normalised.
+        """
+        dist = self._dist(theta, phi, psi, dx, dy, dz)
+        d_i2 = np.einsum('ij,ij->j', dist, dist, out=self._d2_buf)
+        d_i2 += self.d0s2
+        np.reciprocal(d_i2, out=d_i2)
 
-    def _rmsd(self, theta, phi, psi, dx, dy, dz):
-        matrix = self.get_matrix(theta, phi, psi, dx, dy, dz)
-        coord = matrix.dot(self.coord2)
-        dist = coord - self.coord1
-        return (dist * dist)
+        return -self.d0s2 * d_i2
 
+    def _grad(self, dist, weights, trig):
+        """
+        Gradient of sum_j f(d_j^2) with respect to the parameters, given the
+        distance vectors d_j, the weights f'(d_j^2), and the rotation in
+        self._rotation with its trig terms, as returned by _dist_trig.
+        """
+        # G_ab = 2 sum_j w_j d_aj c2_bj, so that d/dp = sum_ab dR_ab/dp G_ab
+        wdist = np.multiply(dist, weights, out=self._coord_buf)
+        g = 2 * wdist.dot(self.coord2.T)
+        g_t = 2 * wdist.sum(axis=1)
+
+        rotation = self._rotation
+        cx, cy, cz, sx, sy, sz = trig
+
+        # dR/dtheta has rows (R_1, -R_0, 0), and dR/dpsi columns (-R_1, R_0, 0).
+        g_theta = rotation[1].dot(g[0]) - rotation[0].dot(g[1])
+        g_psi = rotation[:, 0].dot(g[:, 1]) - rotation[:, 1].dot(g[:, 0])
+        sxsy = sx * sy
+        cxsy = cx * sy
+        g_phi = (sz * (sxsy * g[0, 0] + cxsy * g[1, 0] + cy * g[2, 0]) -
+                 cz * (sxsy * g[0, 1] + cxsy * g[1, 1] + cy * g[2, 1]) +
+                 sx * cy * g[0, 2] + cx * cy * g[1, 2] - sy * g[2, 2])
+
+        return np.array((g_theta, g_phi, g_psi, g_t[0], g_t[1], g_t[2]),
+                        dtype=np.float64)
+
+    def _score_grad(self, d02, theta, phi, psi, dx, dy, dz):
+        """
+        Gradient of -sum_j d02 / (d02 + d_j^2), the TM or S score targets.
+        """
+        dist, trig = self._dist_trig(theta, phi, psi, dx, dy, dz)
+        weights = np.einsum('ij,ij->j', dist, dist, out=self._d2_buf)
+        weights += d02
+        np.square(weights, out=weights)
+        np.divide(d02, weights, out=weights)
+        return self._grad(dist, weights, trig)
+
+    # The reported scores are computed in double precision, see _d_i2_exact.
     def tmscore(self, theta, phi, psi, dx, dy, dz):
-        return -np.mean(self._tm(theta, phi, psi, dx, dy, dz))
+        return np.mean(self.tmscore_samples(theta, phi, psi, dx, dy, dz))
 
     def tmscore_samples(self, theta, phi, psi, dx, dy, dz):
-        return -self._tm(theta, phi, psi, dx, dy, dz)
+        return self._score_samples(self.d02, theta, phi, psi, dx, dy, dz)
 
     def sscore(self, theta, phi, psi, dx, dy, dz):
-        return -np.mean(self._s(theta, phi, psi, dx, dy, dz))
+        return np.mean(self.sscore_samples(theta, phi, psi, dx, dy, dz))
 
     def sscore_samples(self, theta, phi, psi, dx, dy, dz):
-        return -self._s(theta, phi, psi, dx, dy, dz)
+        return self._score_samples(self.d0s2, theta, phi, psi, dx, dy, dz)
 
     def rmsd(self, theta, phi, psi, dx, dy, dz):
-        return np.sqrt(np.mean(self._rmsd(theta, phi, psi, dx, dy, dz)))
+        return np.sqrt(np.mean(self._d_i2_exact(theta, phi, psi, dx, dy, dz)))
 
     def write(self, outputfile='out.pdb', appended=False):
         """
@@ -191,32 +425,30 @@ class Aligning(object):
 
         If appended is True, both are saved as different chains.
         """
-        # FIXME some cases don't work.
         matrix = self.get_matrix(**self.get_current_values())
 
+        atoms = _read_atoms(self.pdb2, self.chain_2)
+
+        # Transform all the atoms at once.
+        coord = np.array([m.group(4, 5, 6) for m in atoms],
+                         dtype=DTYPE).reshape(-1, 3).T
+        coord = _apply_rt(matrix[:3, :3], matrix[:3, 3], coord)
+
         out = open(outputfile, 'w')
         atomid = 1
         if appended:
-            for line in open(self.pdb1):
-                if not line.startswith('ATOM') or (line[21] != self.chain_1 and line[21] != ' '):
-                    continue
+            for m in _read_atoms(self.pdb1, self.chain_1):
+                line = m.group(0)
                 out.write(line[:7])
                 out.write('{: >4}'.format(atomid))
                 atomid += 1
                 out.write(line[11:21])
                 out.write('A')
                 out.write(line[22:])
+                out.write('\n')
 
-        for line in open(self.pdb2):
-            if not line.startswith('ATOM') or (line[21] != self.chain_2 and line[21] != ' '):
-                continue
-
-            x = float(line[32:38])
-            y = float(line[39:46])
-            z = float(line[48:54])
-            vec = np.array([x, y, z, 1])
-            x, y, z, _ = matrix.dot(vec)
-
+        for m, (x, y, z) in zip(atoms, coord.T):
+            line = m.group(0)
             out.write(line[:7])
             out.write('{: >4}'.format(atomid))
             atomid += 1
@@ -224,7 +456,8 @@ class Aligning(object):
             out.write('B')
             out.write(line[22:30])
             out.write('{:>8.3f}{:>8.3f}{:>8.3f}'.format(x, y, z))
-            out.write(line[54:])
+            out.write(m.group(7))
+            out.write('\n')
 
         out.close()
 
@@ -233,69 +466,50 @@ class Aligning(object):
         Extract the sequences from the PDB file, perform the alignment,
         and load the coordinates of the CA of the common residues.
         """
-        parser = PDB.PDBParser(QUIET=True)
-        ppb = PDB.PPBuilder()
-
-        structure1 = parser.get_structure(chain1, self.pdb1)
-        structure2 = parser.get_structure(chain2, self.pdb2)
-
-        seq1 = str(ppb.build_peptides(structure1)[0].get_sequence())
-        seq2 = str(ppb.build_peptides(structure2)[0].get_sequence())
+        _, has_ca1, coords1, seq1 = _load_coords(self.pdb1)
+        _, has_ca2, coords2, seq2 = _load_coords(self.pdb2)
+        for pdb, seq in ((self.pdb1, seq1), (self.pdb2, seq2)):
+            if seq is None:
+                raise ValueError('No peptide found in {}'.format(pdb))
 
         # Alignment parameters taken from PconsFold renumbering script.
         align = pairwise2.align.globalms(seq1, seq2, 2, -1, -0.5, -0.1)[0]
         indexes = set(i for i, (s1, s2) in enumerate(zip(align[0], align[1]))
                       if s1 != '-' and s2 != '-')
-        coord1 = np.hstack([np.concatenate((r['CA'].get_coord(), (1,)))[:, None]
-                            for i, r in enumerate(structure1.get_residues())
-                            if i in indexes and 'CA' in r]).astype(DTYPE,
-                                                                   copy=False)
-        coord2 = np.hstack([np.concatenate((r['CA'].get_coord(), (1,)))[:, None]
-                            for i, r in enumerate(structure2.get_residues())
-                            if i in indexes and 'CA' in r]).astype(DTYPE,
-                                                                   copy=False)
-
-        self.coord1 = coord1
-        self.coord2 = coord2
+        columns1 = [i for i, ca in enumerate(has_ca1) if i in indexes and ca]
+        columns2 = [i for i, ca in enumerate(has_ca2) if i in indexes and ca]
+
+        self.coord1 = np.ascontiguousarray(coords1[:, columns1])
+        self.coord2 = np.ascontiguousarray(coords2[:, columns2])
         self.N = len(seq1)
 
     def _load_data_index(self, chain1, chain2):
         """
         Load the coordinates of the CA of the common residues.
         """
-        parser = PDB.PDBParser(QUIET=True)
-
-        structure1 = parser.get_structure(chain1, self.pdb1)
-        structure2 = parser.get_structure(chain2, self.pdb2)
+        ids1, has_ca1, coords1, _ = _load_coords(self.pdb1)
+        ids2, has_ca2, coords2, _ = _load_coords(self.pdb2)
 
-        residues1 = list(structure1.get_residues())
-        residues2 = list(structure2.get_residues())
-
-        indexes1 = set(r.id[1] for r in residues1)
-        indexes2 = set(r.id[1] for r in residues2)
-
-        indexes = indexes1.intersection(indexes2)
+        indexes = set(ids1).intersection(ids2)
         self.indexes = indexes.copy()
         self.N = len(indexes)
 
-        coord1 = []
+        columns1 = []
         indexes1 = indexes.copy()
-        for r in residues1:
-            if r.id[1] in indexes1 and 'CA' in r:
-                coord1.append(np.concatenate((r['CA'].get_coord(), (1,)))[:, None])
+        for i, (index, ca) in enumerate(zip(ids1, has_ca1)):
+            if index in indexes1 and ca:
+                columns1.append(i)
                 # Remove from index to avoid repeated residues
-                indexes1.remove(r.id[1])
-        coord1 = np.hstack(coord1).astype(DTYPE, copy=False)
+                indexes1.remove(index)
 
-        coord2 = []
-        for r in residues2:
-            if r.id[1] in indexes and 'CA' in r:
-                coord2.append(np.concatenate((r['CA'].get_coord(), (1,)))[:, None])
-                indexes.remove(r.id[1])
-        coord2 = np.hstack(coord2).astype(DTYPE, copy=False)
+        columns2 = []
+        for i, (index, ca) in enumerate(zip(ids2, has_ca2)):
+            if index in indexes and ca:
+                columns2.append(i)
+                indexes.remove(index)
 
-        self.coord1 = coord1
-        self.coord2 = coord2
+        self.coord1 = np.ascontiguousarray(coords1[:, columns1])
+        self.coord2 = np.ascontiguousarray(coords2[:, columns2])
 
 
 class TMscoring(Aligning):
@@ -304,7 +518,10 @@ class TMscoring(Aligning):
     """
 
     def __call__(self, theta, phi, psi, dx, dy, dz):
-        return self._tm(theta, phi, psi, dx, dy, dz).sum()
+        return self._tm_sum(theta, phi, psi, dx, dy, dz)
+
+    def grad(self, theta, phi, psi, dx, dy, dz):
+        return self._score_grad(self.d02, theta, phi, psi, dx, dy, dz)
 
     @staticmethod
     def errordef():
@@ -319,6 +536,9 @@ class Sscoring(Aligning):
     def __call__(self, theta, phi, psi, dx, dy, dz):
         return self._s(theta, phi, psi, dx, dy, dz).sum()
 
+    def grad(self, theta, phi, psi, dx, dy, dz):
+        return self._score_grad(self.d0s2, theta, phi, psi, dx, dy, dz)
+
     @staticmethod
     def errordef():
         return 0.01
@@ -330,7 +550,12 @@ class RMSDscoring(Aligning):
     """
 
     def __call__(self, theta, phi, psi, dx, dy, dz):
-        return self._rmsd(theta, phi, psi, dx, dy, dz).sum()
+        dist = self._dist(theta, phi, psi, dx, dy, dz)
+        return np.einsum('ij,ij->', dist, dist)
+
+    def grad(self, theta, phi, psi, dx, dy, dz):
+        dist, trig = self._dist_trig(theta, phi, psi, dx, dy, dz)
+        return self._grad(dist, 1., trig)
 
     @staticmethod
     def errordef():
@@ -345,3 +570,29 @@ def get_tm(pdb1, pdb2):
 def get_rmsd(pdb1, pdb2):
     rmsd_sc = RMSDscoring(pdb1, pdb2)
     return rmsd_sc.optimise()[2]
+
+
+def _map_pairs(function, pairs, workers):
+    pairs = list(pairs)
+    # Forked workers can deadlock on the threads of the parallel Numba
+    # kernel; then start fresh interpreters instead.
+    context = multiprocessing.get_context('spawn') if parallel_kernel_used() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        return list(executor.map(function, [p[0] for p in pairs],
+                                 [p[1] for p in pairs]))
+
+
+def get_tm_many(pairs, workers=None):
+    """
+    Compute get_tm for each (pdb1, pdb2) in pairs, in parallel over
+    workers processes (by default, as many as CPUs).
+    """
+    return _map_pairs(get_tm, pairs, workers)
+
+
+def get_rmsd_many(pairs, workers=None):
+    """
+    Compute get_rmsd for each (pdb1, pdb2) in pairs, in parallel over
+    workers processes (by default, as many as CPUs).
+    """
+    return _map_pairs(get_rmsd, pairs, workers)